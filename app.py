@@ -1,35 +1,66 @@
+import datetime
+import io
+import hashlib
+import importlib.util
+import itertools
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import pandas as pd
 import numpy as np
+import pyarrow as pa
 import duckdb
 import plotly.express as px
 import plotly.graph_objects as go
-import seaborn as sns
-import matplotlib.pyplot as plt
-import requests
+import plotly.io as pio
 
 # ----------------------------
 # PAGE CONFIG
 # ----------------------------
 st.set_page_config("Smart Data Dashboard", layout="wide")
 
-# ----------------------------
-# FONT
-# ----------------------------
-st.markdown("""
+SCATTER_WEBGL_ROWS = 1_000
+SCATTER_RASTER_ROWS = 50_000
+M4_BINS = 2_000
+MAX_CATEGORY_VALUES = 10_000
+PAIR_PLOT_MAX_COLS = 6
+PAIR_PLOT_MAX_ROWS = 20_000
+MAX_LOAD_WORKERS = 8
+EXCEL_CHUNK_ROWS = 50_000
+LARGE_CSV_BYTES = 100 * 1024 * 1024
+PREVIEW_ROWS = 200
+MAX_SQL_ROWS = 1_000_000
+BAR_AGG_ROWS = 1_000
+BAR_AGG_LIMIT = 50
+
+PALETTES = {
+    "Default": px.colors.qualitative.Plotly,
+    "Pastel": px.colors.qualitative.Pastel,
+    "Bold": px.colors.qualitative.Bold,
+    "Dark": px.colors.qualitative.Dark24,
+    "Sunset": px.colors.sequential.Sunset
+}
+
+FONT_CSS = """
 <style>
 html, body, [class*="css"] {
     font-family: Inter, -apple-system, BlinkMacSystemFont,
                  "Segoe UI", Roboto, Helvetica, Arial, sans-serif;
 }
 </style>
-""", unsafe_allow_html=True)
+"""
 
-# ----------------------------
-# LIGHT / DARK MODE
-# ----------------------------
-dark = st.toggle("🌗 Dark Mode")
-st.markdown(f"""
+
+@st.cache_resource
+def theme_css(dark: bool) -> str:
+    # The script body reruns every time; build each stylesheet only once
+    return FONT_CSS + f"""
 <style>
 .stApp {{
     background-color: {"#0E1117" if dark else "#FAF9F6"};
@@ -39,7 +70,460 @@ h1,h2,h3,h4,h5,p,label {{
     color: {"#EDEDED" if dark else "#1F2937"} !important;
 }}
 </style>
-""", unsafe_allow_html=True)
+"""
+
+# -------------------------------------------------
+# CACHED LOADERS
+# -------------------------------------------------
+EXCEL_ENGINE = "calamine" if importlib.util.find_spec("python_calamine") else None
+if importlib.util.find_spec("orjson"):
+    pio.json.config.default_engine = "orjson"
+
+
+def shrink_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    # Numbers keep their width: DuckDB computes in the column type, so an
+    # int8 column overflows on capacity + capacity and a float32 one turns
+    # x / 3 into 5.833333492279053. Only repeated strings are compacted.
+    for col in df.columns:
+        s = df[col]
+        if (
+            (pd.api.types.is_object_dtype(s) or pd.api.types.is_string_dtype(s))
+            and len(s) and s.nunique() / len(s) < 0.5
+        ):
+            df[col] = s.astype("category")
+    return df
+
+
+def file_digest(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def fingerprint(df: pd.DataFrame) -> str:
+    # Stamped once per dataset; cached helpers hash this, not the frame
+    return df.attrs["_fingerprint"]
+
+
+BY_FINGERPRINT = {pd.DataFrame: fingerprint}
+
+
+def excel_cell(value):
+    # Same conversions as pandas' calamine reader: integral floats become
+    # ints, and dates (calamine's type for midnight datetimes) datetimes.
+    # Empty cells, reported as "", become None.
+    if value == "":
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+        return datetime.datetime(value.year, value.month, value.day)
+    return value
+
+
+def sheet_header(cells) -> list:
+    # Mirror pandas: blank headers become "Unnamed: i", repeats get ".n"
+    header, seen = [], {}
+    for i, cell in enumerate(map(excel_cell, cells)):
+        name = cell if cell is not None else f"Unnamed: {i}"
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        header.append(name)
+    return header
+
+
+def read_workbook(data: bytes) -> dict[str, pd.DataFrame]:
+    if EXCEL_ENGINE is None:
+        return pd.read_excel(io.BytesIO(data), sheet_name=None)
+
+    from python_calamine import CalamineWorkbook
+
+    # Build each sheet from bounded row chunks, so only one chunk of Python
+    # cell objects is alive at a time instead of the whole sheet
+    wb = CalamineWorkbook.from_filelike(io.BytesIO(data))
+    sheets = {}
+    for sheet in wb.sheet_names:
+        rows = wb.get_sheet_by_name(sheet).iter_rows()
+        header = sheet_header(next(rows, []))
+        chunks = []
+        while batch := list(itertools.islice(rows, EXCEL_CHUNK_ROWS)):
+            chunks.append(pd.DataFrame(
+                [[excel_cell(cell) for cell in row] for row in batch], columns=header
+            ).infer_objects())
+        # Infer again after the concat: a chunk with only empty cells in a
+        # column leaves it object-typed
+        sheets[sheet] = (
+            pd.concat(chunks, ignore_index=True).infer_objects() if chunks
+            else pd.DataFrame(columns=header)
+        )
+    return sheets
+
+
+@st.cache_data(show_spinner=False)
+def load_file(name: str, digest: str, _data: bytes) -> dict[str, pd.DataFrame]:
+    # Returns one frame per dataset: the CSV itself or each workbook sheet.
+    # Keyed on the digest so Streamlit doesn't hash the raw bytes again.
+    if name.endswith(".csv"):
+        try:
+            df = pd.read_csv(io.BytesIO(_data), engine="pyarrow")
+        except (ImportError, ValueError):
+            # pyarrow missing or rejected the file: fall back to the C parser
+            df = pd.read_csv(
+                io.BytesIO(_data), engine="c", low_memory=False, cache_dates=True
+            )
+        datasets = {name: df}
+    else:
+        # A sheet with no columns (e.g. a blank Sheet2) is not a dataset
+        sheets = {
+            sheet: df for sheet, df in read_workbook(_data).items() if len(df.columns)
+        }
+        if len(sheets) == 1:
+            datasets = {name: next(iter(sheets.values()))}
+        else:
+            datasets = {f"{name}__{sheet}": df for sheet, df in sheets.items()}
+
+    for dataset, df in datasets.items():
+        shrink_dtypes(df)
+        df.attrs["_fingerprint"] = f"{digest}/{dataset}"
+    return datasets
+
+
+@st.cache_data(show_spinner=False)
+def classify_cols(dtypes_key: tuple, _df: pd.DataFrame) -> list:
+    return _df.select_dtypes(include=np.number).columns.tolist()
+
+
+def numeric_cols(df: pd.DataFrame) -> list:
+    # Keyed on the (name, dtype) signature, not the data
+    return classify_cols(tuple((c, str(t)) for c, t in df.dtypes.items()), df)
+
+
+@st.cache_data(show_spinner=False, hash_funcs=BY_FINGERPRINT)
+def unique_vals(df: pd.DataFrame, col) -> np.ndarray:
+    s = df[col]
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        return s.cat.categories.to_numpy()[:MAX_CATEGORY_VALUES]
+    if pd.api.types.is_object_dtype(s):
+        # DuckDB would hand mixed values (10, "A7") back as text, which then
+        # matches no cell in first_row_index
+        return s.dropna().unique()[:MAX_CATEGORY_VALUES]
+    with temp_view("__distinct_source", df[[col]]) as con:
+        return con.execute(
+            f"SELECT DISTINCT {quote_ident(col)} FROM __distinct_source "
+            f"WHERE {quote_ident(col)} IS NOT NULL ORDER BY 1 LIMIT ?",
+            [MAX_CATEGORY_VALUES]
+        ).df().iloc[:, 0].to_numpy()
+
+
+@st.cache_data(show_spinner=False, hash_funcs=BY_FINGERPRINT)
+def first_row_index(df: pd.DataFrame, col, value) -> int:
+    s = df[col]
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        # Compare small integer codes instead of the object values
+        if value not in s.cat.categories:
+            return -1
+        hits = np.flatnonzero(s.cat.codes.to_numpy() == s.cat.categories.get_loc(value))
+    else:
+        hits = np.flatnonzero(s.to_numpy() == value)
+    return int(hits[0]) if hits.size else -1
+
+
+def table_name_for(file_name: str) -> str:
+    return file_name.replace(".", "_").replace(" ", "_")
+
+
+def spill_path(table_name: str, digest: str) -> str:
+    return os.path.join(st.session_state["spill_dir"], f"{table_name}-{digest}.csv")
+
+
+def remove_spill(table_name: str, digest: str):
+    try:
+        os.remove(spill_path(table_name, digest))
+    except FileNotFoundError:
+        pass
+
+
+def load_all(files) -> list:
+    # Parsers release the GIL, so files are read concurrently.
+    # Large CSVs are only written to disk here; DuckDB scans them in place
+    # and the pandas frame is built on first use (see dataset_frame).
+    ctx = get_script_run_ctx()
+
+    def load(f):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        data = f.getvalue()
+        digest = file_digest(data)
+        if f.name.endswith(".csv") and len(data) > LARGE_CSV_BYTES:
+            path = spill_path(table_name_for(f.name), digest)
+            if not os.path.exists(path):
+                # Write under a temporary name: path only ever holds a whole file
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".part")
+                with os.fdopen(fd, "wb") as out:
+                    out.write(data)
+                os.replace(tmp, path)
+            return digest, {f.name: None}
+        return digest, load_file(f.name, digest, data)
+
+    with ThreadPoolExecutor(max_workers=min(MAX_LOAD_WORKERS, len(files))) as ex:
+        return list(ex.map(load, files))
+
+
+def arrow_table(df: pd.DataFrame) -> pa.Table:
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        pass
+    # Mixed-type columns (e.g. 10, "A7", 30) can't be typed: give DuckDB text
+    df = df.copy(deep=False)
+    for col in df.columns:
+        try:
+            pa.array(df[col], from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            df[col] = df[col].astype("string")
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def get_con():
+    # One connection per session, kept across reruns
+    if "con" not in st.session_state:
+        st.session_state["con"] = duckdb.connect(database=":memory:")
+        st.session_state["registered"] = {}
+        st.session_state["sql_writes"] = 0
+        # Large CSV spills live as long as the session's connection
+        st.session_state["spill_dir"] = tempfile.mkdtemp(prefix="power-aid-")
+        weakref.finalize(
+            st.session_state["con"], shutil.rmtree, st.session_state["spill_dir"], True
+        )
+    return st.session_state["con"]
+
+
+@contextmanager
+def temp_view(name: str, data):
+    # Expose a frame to DuckDB for the duration of one helper query
+    con = get_con()
+    con.register(name, data)
+    try:
+        yield con
+    finally:
+        con.unregister(name)
+
+
+def pandas_ready(table: pa.Table) -> pa.Table:
+    # What DuckDB's .df() did: repeated names get _1, _2, ... (compared
+    # case-insensitively), and DECIMAL/HUGEINT columns such as integer SUMs
+    # become float64 instead of object columns of Decimal
+    names, taken, counts = [], set(), {}
+    for name in table.column_names:
+        new = name
+        while new.lower() in taken:
+            counts[name.lower()] = counts.get(name.lower(), 0) + 1
+            new = f"{name}_{counts[name.lower()]}"
+        taken.add(new.lower())
+        names.append(new)
+    table = table.rename_columns(names)
+    for i, field in enumerate(table.schema):
+        if pa.types.is_decimal(field.type):
+            table = table.set_column(i, field.name, table.column(i).cast(pa.float64()))
+    return table
+
+
+def query_arrow(sql: str, statements: list) -> pa.Table:
+    con = get_con()
+    if statements[-1].type != duckdb.StatementType.SELECT:
+        # CREATE, INSERT, SET, ...: execute() returns the Count/Success row
+        return pandas_ready(con.execute(sql).to_arrow_table())
+    # Fetch one row past the cap so oversized results are caught in one pass
+    result = con.sql(sql).limit(MAX_SQL_ROWS + 1).to_arrow_table()
+    if result.num_rows > MAX_SQL_ROWS:
+        raise ValueError(
+            f"Query returns more than {MAX_SQL_ROWS:,} rows. "
+            "Add a LIMIT or aggregate before visualizing."
+        )
+    return pandas_ready(result)
+
+
+def session_writes():
+    # Until a session changes DuckDB state itself, it sees only the uploads,
+    # so its SELECT results can be shared across sessions
+    writes = st.session_state["sql_writes"]
+    return (get_script_run_ctx().session_id, writes) if writes else None
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def cached_select(sql: str, table_versions: tuple, writes, _statements: list) -> pa.Table:
+    # table_versions and writes only key the cache
+    return query_arrow(sql, _statements)
+
+
+def run_sql(sql: str, table_versions: tuple) -> pa.Table:
+    statements = duckdb.extract_statements(sql)
+    if not statements:
+        raise ValueError("Enter a query to run.")
+    if all(stmt.type == duckdb.StatementType.SELECT for stmt in statements):
+        return cached_select(sql, table_versions, session_writes(), statements)
+    # CREATE, INSERT, SET, ... always run, and later SELECTs miss the cache
+    try:
+        return query_arrow(sql, statements)
+    finally:
+        st.session_state["sql_writes"] += 1
+
+
+def plot_array(values) -> np.ndarray:
+    # Plotly base64-encodes typed arrays, but not 64-bit ints
+    arr = np.ascontiguousarray(values)
+    if arr.dtype.kind in "iu" and arr.itemsize == 8:
+        info = np.iinfo(np.int32)
+        if arr.size == 0 or (arr.min() >= info.min and arr.max() <= info.max):
+            return arr.astype(np.int32)
+        return arr.astype(np.float64)
+    return arr
+
+
+def density_figure(x_arr, y_arr, x, y, width=800, height=500):
+    # Bin points into a fixed-size grid so the payload doesn't grow with rows
+    ok = np.isfinite(x_arr) & np.isfinite(y_arr)
+    counts, x_edges, y_edges = np.histogram2d(
+        x_arr[ok], y_arr[ok], bins=(width, height)
+    )
+    counts = counts.T.astype(np.float32)
+    counts[counts == 0] = np.nan
+    return px.imshow(
+        counts,
+        x=(x_edges[:-1] + x_edges[1:]) / 2,
+        y=(y_edges[:-1] + y_edges[1:]) / 2,
+        origin="lower",
+        aspect="auto",
+        labels={"x": x, "y": y, "color": "points"},
+        color_continuous_scale="Inferno"
+    )
+
+
+def quote_ident(name) -> str:
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+@st.cache_data(show_spinner=False, hash_funcs=BY_FINGERPRINT)
+def correlation_matrix(df: pd.DataFrame, cols: tuple) -> np.ndarray:
+    nums = df[list(cols)]
+    arr = nums.to_numpy(dtype=np.float64)
+    if not np.isnan(arr).any():
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.corrcoef(arr, rowvar=False)
+
+    # Missing values: DuckDB's corr() skips NULL pairs like pandas does,
+    # and computes every pair in a single scan
+    pairs = [(i, j) for i in range(len(cols)) for j in range(i, len(cols))]
+    select = ", ".join(
+        f"corr({quote_ident(cols[i])}, {quote_ident(cols[j])})" for i, j in pairs
+    )
+    with temp_view("__corr_source", pa.Table.from_pandas(nums, preserve_index=False)) as con:
+        values = con.execute(f"SELECT {select} FROM __corr_source").fetchone()
+
+    out = np.full((len(cols), len(cols)), np.nan)
+    for (i, j), v in zip(pairs, values):
+        if v is not None:
+            out[i, j] = out[j, i] = v
+    return out
+
+
+@st.cache_data(show_spinner=False, hash_funcs=BY_FINGERPRINT)
+def pair_plot_sample(df: pd.DataFrame, dims: tuple) -> pd.DataFrame:
+    sample = df[list(dims)]
+    if len(sample) > PAIR_PLOT_MAX_ROWS:
+        sample = sample.sample(PAIR_PLOT_MAX_ROWS, random_state=0)
+    return sample
+
+
+@st.cache_data(show_spinner=False, hash_funcs=BY_FINGERPRINT)
+def aggregate_bar(df: pd.DataFrame, x, y) -> pd.DataFrame:
+    # Sum y per x in DuckDB and keep the largest groups
+    with temp_view("__viz_source", arrow_table(df[list(dict.fromkeys([x, y]))])) as con:
+        return con.execute(
+            f"SELECT {quote_ident(x)} AS x, SUM(TRY_CAST({quote_ident(y)} AS DOUBLE)) AS y "
+            "FROM __viz_source GROUP BY 1 ORDER BY 2 DESC NULLS LAST LIMIT ?",
+            [BAR_AGG_LIMIT]
+        ).df()
+
+
+@st.cache_data(show_spinner=False, hash_funcs=BY_FINGERPRINT)
+def x_is_ordered(df: pd.DataFrame, x) -> bool:
+    return bool(df[x].is_monotonic_increasing)
+
+
+@st.cache_data(show_spinner=False, hash_funcs=BY_FINGERPRINT)
+def m4_downsample(df: pd.DataFrame, x, y, bins: int = M4_BINS) -> pd.DataFrame:
+    # M4: keep the first, last, lowest and highest point of every x bin,
+    # which is all a line drawn at that width can show. One aggregation
+    # pass picks all four with arg_min/arg_max.
+    source = pd.DataFrame({"x": df[x].to_numpy(), "y": df[y].to_numpy()})
+    with temp_view("__m4_source", pa.Table.from_pandas(source, preserve_index=False)) as con:
+        return con.execute(
+            """
+            WITH binned AS (
+                SELECT s.x, s.y, floor(? * (s.x - r.lo) / nullif(r.hi - r.lo, 0)) AS k
+                FROM __m4_source s,
+                     (SELECT min(x)::DOUBLE AS lo, max(x)::DOUBLE AS hi FROM __m4_source) r
+                WHERE s.x IS NOT NULL AND s.y IS NOT NULL
+            ),
+            m4 AS (
+                SELECT min(x) AS x_first, arg_min(y, x) AS y_first,
+                       max(x) AS x_last, arg_max(y, x) AS y_last,
+                       arg_min(x, y) AS x_low, min(y) AS y_low,
+                       arg_max(x, y) AS x_high, max(y) AS y_high
+                FROM binned
+                GROUP BY k
+            )
+            SELECT DISTINCT x, y FROM (
+                SELECT x_first AS x, y_first AS y FROM m4
+                UNION ALL SELECT x_last, y_last FROM m4
+                UNION ALL SELECT x_low, y_low FROM m4
+                UNION ALL SELECT x_high, y_high FROM m4
+            )
+            ORDER BY x
+            """,
+            [bins]
+        ).df()
+
+
+def show_table(data):
+    # Only a window of rows is ever visible; don't ship the whole result
+    if len(data) > PREVIEW_ROWS:
+        st.caption(f"Showing first {PREVIEW_ROWS:,} of {len(data):,} rows")
+        data = data[:PREVIEW_ROWS]  # row slice for both pandas and Arrow
+    st.dataframe(data, use_container_width=True)
+
+
+def dataset_frame(name: str) -> pd.DataFrame:
+    if dataframes[name] is not None:
+        return dataframes[name]
+    # Large CSV kept as a DuckDB view: materialize only the selected one,
+    # in session state, since st.cache_data would copy it on every hit
+    table_name = table_name_for(name)
+    key = (table_name, registered[table_name])
+    frames = st.session_state.setdefault("view_frames", {})
+    if key not in frames:
+        frames.clear()
+        df = get_con().execute(f"SELECT * FROM {quote_ident(table_name)}").to_arrow_table().to_pandas()
+        shrink_dtypes(df)
+        df.attrs["_fingerprint"] = f"{key[1]}/{name}"
+        frames[key] = df
+    return frames[key]
+
+
+def sql_result_df() -> pd.DataFrame:
+    # The query result is kept as Arrow; convert once, on first pandas use
+    if "sql_result_df" not in st.session_state:
+        df = st.session_state["sql_result"].to_pandas()
+        df.attrs["_fingerprint"] = file_digest(repr(st.session_state["sql_key"]).encode())
+        st.session_state["sql_result_df"] = df
+    return st.session_state["sql_result_df"]
+
+# ----------------------------
+# FONT + LIGHT / DARK MODE
+# ----------------------------
+dark = st.toggle("🌗 Dark Mode")
+st.markdown(theme_css(dark), unsafe_allow_html=True)
 
 # ----------------------------
 # TITLE
@@ -71,17 +555,41 @@ if not uploaded_files:
 # LOAD FILES + DUCKDB
 # -------------------------------------------------
 dataframes = {}
-con = duckdb.connect(database=":memory:")
-
-for f in uploaded_files:
-    if f.name.endswith(".csv"):
-        df_tmp = pd.read_csv(f)
-    else:
-        df_tmp = pd.read_excel(f)
-
-    table_name = f.name.replace(".", "_").replace(" ", "_")
-    dataframes[f.name] = df_tmp
-    con.register(table_name, df_tmp)
+con = get_con()
+registered = st.session_state["registered"]
+
+for f, (digest, datasets) in zip(uploaded_files, load_all(uploaded_files)):
+    if not datasets:
+        st.error(f"{f.name} has no sheets with data.")
+    for name, df_tmp in datasets.items():
+        table_name = table_name_for(name)
+        dataframes[name] = df_tmp
+        if registered.get(table_name) == digest:
+            continue
+        if df_tmp is None:
+            con.unregister(table_name)
+            path = spill_path(table_name, digest).replace("'", "''")
+            con.execute(
+                f"CREATE OR REPLACE TEMP VIEW {quote_ident(table_name)} AS "
+                f"SELECT * FROM read_csv_auto('{path}')"
+            )
+        else:
+            con.execute(f"DROP VIEW IF EXISTS {quote_ident(table_name)}")
+            con.register(table_name, arrow_table(df_tmp))
+        if table_name in registered:
+            # Re-uploaded with new content: the old spill, if any, is unused
+            remove_spill(table_name, registered[table_name])
+        registered[table_name] = digest
+
+# Drop tables whose file was removed from the uploader
+current_tables = {table_name_for(name) for name in dataframes}
+for table_name in set(registered) - current_tables:
+    con.unregister(table_name)
+    con.execute(f"DROP VIEW IF EXISTS {quote_ident(table_name)}")
+    remove_spill(table_name, registered.pop(table_name))
+
+if not dataframes:
+    st.stop()
 
 # -------------------------------------------------
 # SIDEBAR CONTROLS
@@ -101,19 +609,9 @@ with st.sidebar:
         ]
     )
 
-    palette_name = st.selectbox(
-        "🎨 Color Palette",
-        ["Default", "Pastel", "Bold", "Dark", "Sunset"]
-    )
+    palette_name = st.selectbox("🎨 Color Palette", list(PALETTES))
 
-palette_map = {
-    "Default": px.colors.qualitative.Plotly,
-    "Pastel": px.colors.qualitative.Pastel,
-    "Bold": px.colors.qualitative.Bold,
-    "Dark": px.colors.qualitative.Dark24,
-    "Sunset": px.colors.sequential.Sunset
-}
-colors = palette_map[palette_name]
+colors = PALETTES[palette_name]
 
 # -------------------------------------------------
 # SQL QUERY UI (REPLACED)
@@ -122,27 +620,34 @@ st.markdown("---")
 st.header("🧠 SQL Query Engine")
 
 st.markdown("**Available Tables:**")
-table_map = {f.name.replace(".", "_").replace(" ", "_"): f.name for f in uploaded_files}
+table_map = {table_name_for(name): name for name in dataframes}
 for f, t in table_map.items():
     st.code(f"{t}  ←  {f}")
 
-sql_query = st.text_area(
-    "Write SQL query",
-    height=180,
-    placeholder="""
+with st.form("sql_form"):
+    sql_query = st.text_area(
+        "Write SQL query",
+        height=180,
+        placeholder="""
 Example:
 SELECT route, COUNT(*) AS total_students
 FROM route_details
 GROUP BY route
 """
-)
+    )
+    submitted = st.form_submit_button("▶ Run Query")
 
-if st.button("▶ Run Query"):
+if submitted:
     try:
-        sql_result = con.execute(sql_query).df()
-        st.success(f"Query executed successfully ({len(sql_result)} rows)")
-        st.dataframe(sql_result, use_container_width=True)
-        st.session_state["sql_result"] = sql_result
+        table_versions = tuple(sorted(registered.items()))
+        sql_result = run_sql(sql_query, table_versions)
+        st.success(f"Query executed successfully ({sql_result.num_rows} rows)")
+        show_table(sql_result)
+        if sql_result.num_columns:
+            # A column-less result has nothing to visualize; keep the last one
+            st.session_state["sql_result"] = sql_result
+            st.session_state["sql_key"] = (sql_query, table_versions, session_writes())
+            st.session_state.pop("sql_result_df", None)
     except Exception as e:
         st.error(f"SQL Error: {e}")
 
@@ -153,112 +658,173 @@ st.markdown("---")
 st.header("📂 Data Source")
 
 selected_file = st.selectbox("Select original file", list(dataframes.keys()))
-df_original = dataframes[selected_file]
 
 use_sql = False
 if "sql_result" in st.session_state:
     use_sql = st.checkbox("Use SQL query result for visualization", value=True)
 
-df_viz = st.session_state["sql_result"] if use_sql else df_original
+df_viz = sql_result_df() if use_sql else dataset_frame(selected_file)
 
 st.write(f"### Active Dataset ({len(df_viz)} records)")
-st.dataframe(df_viz, use_container_width=True)
+show_table(df_viz)
 
 # -------------------------------------------------
 # VISUALIZATIONS
 # -------------------------------------------------
-st.markdown('<div class="section-alt">', unsafe_allow_html=True)
-
-if chart_type == "Bar Chart":
-    st.subheader("📊 Bar Chart")
-    st.info("X → categorical | Y → numeric")
-
-    x = st.selectbox("X-axis", df_viz.columns)
-    y = st.selectbox("Y-axis", df_viz.columns)
-
-    df_viz[y] = pd.to_numeric(df_viz[y], errors="coerce")
-    fig = px.bar(df_viz, x=x, y=y, color_discrete_sequence=colors)
-    fig.update_layout(transition_duration=500)
-    st.plotly_chart(fig, use_container_width=True)
-
-elif chart_type == "Scatter Plot":
-    st.subheader("📈 Scatter Plot")
-    nums = df_viz.select_dtypes(include=np.number).columns
-
-    if len(nums) >= 2:
-        x = st.selectbox("X-axis", nums)
-        y = st.selectbox("Y-axis", nums)
-        fig = px.scatter(df_viz, x=x, y=y, color_discrete_sequence=colors)
+@st.fragment
+def visualization_section(df_viz: pd.DataFrame, chart_type: str, colors: list):
+    # Chart widgets rerun only this section, not the loaders above
+    if df_viz.empty:
+        # e.g. DROP or SET, whose result is an empty Success column
+        st.info("No rows to visualize.")
+        return
+    st.markdown('<div class="section-alt">', unsafe_allow_html=True)
+    nums = numeric_cols(df_viz)
+
+    if chart_type == "Bar Chart":
+        st.subheader("📊 Bar Chart")
+        st.info("X → categorical | Y → numeric")
+
+        x = st.selectbox("X-axis", df_viz.columns)
+        y = st.selectbox("Y-axis", df_viz.columns)
+
+        if len(df_viz) > BAR_AGG_ROWS:
+            st.caption(f"Sum of {y} for the top {BAR_AGG_LIMIT} values of {x}")
+            agg = aggregate_bar(df_viz, x, y)
+            x_arr = plot_array(agg["x"].to_numpy())
+            y_arr = plot_array(agg["y"].to_numpy(dtype=np.float64))
+        else:
+            x_arr = plot_array(df_viz[x].to_numpy())
+            y_arr = plot_array(pd.to_numeric(df_viz[y], errors="coerce").to_numpy(dtype=np.float64))
+        fig = px.bar(
+            x=x_arr, y=y_arr, labels={"x": x, "y": y},
+            color_discrete_sequence=colors
+        )
         fig.update_layout(transition_duration=500)
         st.plotly_chart(fig, use_container_width=True)
-    else:
-        st.warning("Need at least two numeric columns.")
-
-elif chart_type == "Radar Chart":
-    st.subheader("🕸 Radar Chart")
-    cat = st.selectbox("Category column", df_viz.columns)
-    metrics = st.multiselect(
-        "Numeric metrics",
-        df_viz.select_dtypes(include=np.number).columns
-    )
 
-    if metrics:
-        val = st.selectbox("Category value", df_viz[cat].unique())
-        row = df_viz[df_viz[cat] == val][metrics]
+    elif chart_type == "Scatter Plot":
+        st.subheader("📈 Scatter Plot")
+        if len(nums) >= 2:
+            x = st.selectbox("X-axis", nums)
+            y = st.selectbox("Y-axis", nums)
+            if len(df_viz) > SCATTER_RASTER_ROWS and x_is_ordered(df_viz, x):
+                st.caption(f"{len(df_viz):,} points in x order — showing the M4 min/max envelope")
+                m4 = m4_downsample(df_viz, x, y)
+                fig = px.line(
+                    x=plot_array(m4["x"].to_numpy()),
+                    y=plot_array(m4["y"].to_numpy()),
+                    labels={"x": x, "y": y},
+                    color_discrete_sequence=colors,
+                    render_mode="webgl"
+                )
+            else:
+                x_arr = plot_array(df_viz[x].to_numpy())
+                y_arr = plot_array(df_viz[y].to_numpy())
+                if len(df_viz) > SCATTER_RASTER_ROWS:
+                    st.caption(f"{len(df_viz):,} points — showing point density")
+                    fig = density_figure(x_arr, y_arr, x, y)
+                else:
+                    fig = px.scatter(
+                        x=x_arr,
+                        y=y_arr,
+                        labels={"x": x, "y": y},
+                        color_discrete_sequence=colors,
+                        render_mode="webgl" if len(df_viz) > SCATTER_WEBGL_ROWS else "svg"
+                    )
+            fig.update_layout(transition_duration=500)
+            st.plotly_chart(fig, use_container_width=True)
+        else:
+            st.warning("Need at least two numeric columns.")
+
+    elif chart_type == "Radar Chart":
+        st.subheader("🕸 Radar Chart")
+        cat = st.selectbox("Category column", df_viz.columns)
+        metrics = st.multiselect(
+            "Numeric metrics",
+            nums
+        )
 
-        if not row.empty:
-            fig = go.Figure(
-                go.Scatterpolar(
-                    r=row.iloc[0].values,
-                    theta=metrics,
-                    fill="toself"
+        if metrics:
+            val = st.selectbox("Category value", unique_vals(df_viz, cat))
+            idx = first_row_index(df_viz, cat, val)
+
+            if idx >= 0:
+                fig = go.Figure(
+                    go.Scatterpolar(
+                        r=df_viz[metrics].iloc[idx].to_numpy(dtype=np.float64),
+                        theta=metrics,
+                        fill="toself"
+                    )
                 )
+                fig.update_layout(title=val)
+                st.plotly_chart(fig, use_container_width=True)
+
+    elif chart_type == "Pair Plot":
+        st.subheader("🔗 Pair Plot")
+        if len(nums) >= 2:
+            dims = nums[:PAIR_PLOT_MAX_COLS]
+            sample = pair_plot_sample(df_viz, tuple(dims))
+            st.caption(
+                f"{len(dims)} of {len(nums)} numeric columns, "
+                f"{len(sample):,} of {len(df_viz):,} rows"
+            )
+            fig = px.scatter_matrix(
+                sample, dimensions=dims, color_discrete_sequence=colors
+            )
+            fig.update_traces(diagonal_visible=False, marker_size=3)
+            st.plotly_chart(fig, use_container_width=True)
+        else:
+            st.warning("Not enough numeric columns.")
+
+    elif chart_type == "Correlation Heatmap":
+        st.subheader("🔥 Correlation Heatmap")
+        if len(nums) >= 2:
+            fig = px.imshow(
+                correlation_matrix(df_viz, tuple(nums)),
+                x=nums,
+                y=nums,
+                text_auto=".2f",
+                zmin=-1,
+                zmax=1,
+                aspect="auto",
+                color_continuous_scale="RdBu_r"
             )
-            fig.update_layout(title=val)
             st.plotly_chart(fig, use_container_width=True)
+        else:
+            st.warning("Not enough numeric columns.")
 
-elif chart_type == "Pair Plot":
-    st.subheader("🔗 Pair Plot")
-    nums = df_viz.select_dtypes(include=np.number)
-    if nums.shape[1] >= 2:
-        fig = sns.pairplot(nums)
-        st.pyplot(fig)
-    else:
-        st.warning("Not enough numeric columns.")
-
-elif chart_type == "Correlation Heatmap":
-    st.subheader("🔥 Correlation Heatmap")
-    nums = df_viz.select_dtypes(include=np.number)
-    if nums.shape[1] >= 2:
-        fig, ax = plt.subplots(figsize=(10, 6))
-        sns.heatmap(nums.corr(), annot=True, cmap="coolwarm", ax=ax)
-        st.pyplot(fig)
-    else:
-        st.warning("Not enough numeric columns.")
+    st.markdown('</div>', unsafe_allow_html=True)
 
-st.markdown('</div>', unsafe_allow_html=True)
+
+visualization_section(df_viz, chart_type, colors)
 
 # -------------------------------------------------
 # CHATBOT (REAL STATEFUL)
 # -------------------------------------------------
-st.markdown('<div class="card">', unsafe_allow_html=True)
-st.subheader("🧠 Ask Your Data (Chatbot)")
+@st.fragment
+def chatbot_section():
+    st.markdown('<div class="card">', unsafe_allow_html=True)
+    st.subheader("🧠 Ask Your Data (Chatbot)")
 
-if "chat_history" not in st.session_state:
-    st.session_state.chat_history = []
+    if "chat_history" not in st.session_state:
+        st.session_state.chat_history = []
 
-question = st.text_input(
-    "Ask a question (e.g. total students per route)"
-)
+    question = st.text_input(
+        "Ask a question (e.g. total students per route)"
+    )
 
-if st.button("Ask"):
-    if question:
-        st.session_state.chat_history.append(("You", question))
-        st.session_state.chat_history.append(
-            ("Assistant", "LLM integration coming next (SQL generation).")
-        )
+    if st.button("Ask"):
+        if question:
+            st.session_state.chat_history.append(("You", question))
+            st.session_state.chat_history.append(
+                ("Assistant", "LLM integration coming next (SQL generation).")
+            )
+
+    for role, msg in st.session_state.chat_history:
+        st.markdown(f"**{role}:** {msg}")
+
+    st.markdown('</div>', unsafe_allow_html=True)
 
-for role, msg in st.session_state.chat_history:
-    st.markdown(f"**{role}:** {msg}")
 
-st.markdown('</div>', unsafe_allow_html=True)
\ No newline at end of file
+chatbot_section()
\ No newline at end of file
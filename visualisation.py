@@ -10,19 +10,13 @@ Original file is located at
 !pip install streamlit pandas
 !wget https://github.com/cloudflare/cloudflared/releases/latest/download/cloudflared-linux-amd64.deb
 !sudo dpkg -i cloudflared-linux-amd64.deb
-!pip install streamlit-folium folium
 
 # Commented out IPython magic to ensure Python compatibility.
 # %%writefile app.py
 # import streamlit as st
 # import pandas as pd
 # import numpy as np
-# import matplotlib.pyplot as plt
-# import seaborn as sns
 # import plotly.express as px
-# import requests
-# import time
-# from streamlit_folium import st_folium
 # 
 # st.set_page_config(page_title="CSV Dashboard", layout="wide")
 # st.title("CSV Dashboard")
@@ -78,38 +72,38 @@ Original file is located at
 #     # -----------------------------------------
 #     # FIXED: PLOTTING EXACT VALUES (NO AUTO AGGREGATION)
 #     # -----------------------------------------
-#     df_plot = df.copy()
-# 
-#     # If y column is non-numeric, convert safely
-#     if not np.issubdtype(df_plot[col_y].dtype, np.number):
-#         try:
-#             df_plot[col_y] = pd.to_numeric(df_plot[col_y], errors="coerce")
-#         except:
-#             st.error("Y-axis column must be numeric for bar charts.")
-#             st.stop()
+#     # Coerce only the y column, and only when it isn't numeric already; no frame copy
+#     y_series = df[col_y]
+#     if not pd.api.types.is_numeric_dtype(y_series):
+#         y_series = pd.to_numeric(y_series, errors="coerce")
+#     x_values = df[col_x].to_numpy()
+#     y_values = y_series.to_numpy()
+#     bar_labels = {"x": col_x, "y": col_y}
 # 
 #     # ---------------------------
 #     # INTERACTIVE PLOTLY BAR CHARTS
 #     # ---------------------------
 #     if chart_type == "Vertical Bar":
-#         fig = px.bar(df_plot, x=col_x, y=col_y)
+#         fig = px.bar(x=x_values, y=y_values, labels=bar_labels)
 #         fig.update_layout(title="Vertical Bar Chart", xaxis_title=col_x, yaxis_title=col_y, xaxis_tickangle=-45)
 #         st.plotly_chart(fig, use_container_width=True)
 # 
 #     elif chart_type == "Horizontal Bar":
-#         fig = px.bar(df_plot, x=col_y, y=col_x, orientation='h')
+#         fig = px.bar(x=y_values, y=x_values, orientation='h', labels={"x": col_y, "y": col_x})
 #         fig.update_layout(title="Horizontal Bar Chart", xaxis_title=col_y, yaxis_title=col_x)
 #         st.plotly_chart(fig, use_container_width=True)
 # 
 #     elif chart_type == "Grouped Bar":
 #         group_col = st.selectbox("Grouping Column", df.columns, key="groupbar")
-#         fig = px.bar(df_plot, x=col_x, y=col_y, color=group_col, barmode="group")
+#         bar_view = df[list(dict.fromkeys([col_x, group_col]))].assign(**{col_y: y_series})
+#         fig = px.bar(bar_view, x=col_x, y=col_y, color=group_col, barmode="group")
 #         fig.update_layout(title="Grouped Bar Chart", xaxis_tickangle=-45)
 #         st.plotly_chart(fig, use_container_width=True)
 # 
 #     elif chart_type == "Stacked Bar":
 #         stack_col = st.selectbox("Stack Column", df.columns, key="stackbar")
-#         fig = px.bar(df_plot, x=col_x, y=col_y, color=stack_col, barmode="stack")
+#         bar_view = df[list(dict.fromkeys([col_x, stack_col]))].assign(**{col_y: y_series})
+#         fig = px.bar(bar_view, x=col_x, y=col_y, color=stack_col, barmode="stack")
 #         fig.update_layout(title="Stacked Bar Chart", xaxis_tickangle=-45)
 #         st.plotly_chart(fig, use_container_width=True)
 # 
@@ -117,16 +111,15 @@ Original file is located at
 #     # HEATMAPS
 #     # ---------------------------
 #     st.markdown("---")
-#     st.header("Heatmaps (Seaborn)")
+#     st.header("Heatmaps")
 #     heatmap_type = st.selectbox("Choose Heatmap Type", ["Correlation Heatmap", "Pivot Heatmap"])
 # 
 #     if heatmap_type == "Correlation Heatmap":
 #         numeric_df = df.select_dtypes(include=[np.number])
 #         if numeric_df.shape[1] >= 2:
 #             corr = numeric_df.corr()
-#             fig, ax = plt.subplots(figsize=(10, 6))
-#             sns.heatmap(corr, annot=True, cmap="coolwarm", ax=ax)
-#             st.pyplot(fig)
+#             fig = px.imshow(corr, text_auto=".2f", zmin=-1, zmax=1, aspect="auto", color_continuous_scale="RdBu_r")
+#             st.plotly_chart(fig, use_container_width=True)
 #         else:
 #             st.warning("Need at least 2 numeric columns.")
 #     else:
@@ -135,9 +128,8 @@ Original file is located at
 #         val_col = st.selectbox("Value (numeric)", df.columns)
 #         try:
 #             pivot = df.pivot_table(index=y_col, columns=x_col, values=val_col, aggfunc="mean")
-#             fig, ax = plt.subplots(figsize=(10, 6))
-#             sns.heatmap(pivot, annot=True, cmap="viridis", ax=ax)
-#             st.pyplot(fig)
+#             fig = px.imshow(pivot, text_auto=".2f", aspect="auto", color_continuous_scale="Viridis")
+#             st.plotly_chart(fig, use_container_width=True)
 #         except:
 #             st.error("Could not create pivot table. Choose valid columns.")
 # 